@@ -1,76 +1,483 @@
 # database.py
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import create_engine, event, inspect, select, lambda_stmt, bindparam, literal, insert, update, Integer, BigInteger, SmallInteger, String, Text, Boolean, DateTime, ForeignKey, Index, text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session, sessionmaker, relationship, joinedload
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.sql import func
+import asyncio
+import csv
+import enum
+import io
+from itertools import islice
+import logging
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from cachetools import TTLCache
 from config import DATABASE_URL # Import DATABASE_URL from our config file
 
-Base = declarative_base() # This is the base class for our database models
+logger = logging.getLogger(__name__)
+
+# Connection pool settings (can be overridden per deployment via environment variables)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20")) # Connections kept open in the pool
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40")) # Extra connections allowed during bursts
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30")) # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600")) # Seconds before a connection is replaced
+
+# In-process cache of user IDs (can be overridden per deployment via environment variables)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000")) # Users remembered at once
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60")) # Seconds an entry is kept
+
+AGENT_VIEW_REFRESH_DELAY = 5 # Seconds to collect agent status changes before refreshing the agent lookup view
+
+LANGUAGE_CODE_MAX_LENGTH = 8 # Room for codes like "en" or "pt-br"
+
+MESSAGE_MAX_LENGTH = 4096 # Longest text message Telegram allows
+HISTORY_PREVIEW_MAX_LENGTH = 4000 # Latest conversation text kept per request (fits one Telegram message with its heading)
+# Message rows up to this many bytes are kept inline instead of being compressed or moved to TOAST storage (PostgreSQL)
+MESSAGE_TOAST_TUPLE_TARGET = 8160
+
+# This is the base class for our database models
+class Base(DeclarativeBase):
+    pass
 
 # User Model: Represents a customer or a support agent
 class User(Base):
     __tablename__ = 'users' # Table name in the database
-    id = Column(Integer, primary_key=True) # Unique ID for each user
-    telegram_id = Column(Integer, unique=True, nullable=False) # Their Telegram user ID
-    username = Column(String, nullable=True) # Their Telegram username (optional)
-    first_name = Column(String, nullable=True) # Their Telegram first name (optional)
-    is_agent = Column(Boolean, default=False) # True if this user is a support agent
-    language_proficiencies = Column(String) # e.g., "en,es,fr" comma-separated languages an agent can handle
-    is_available = Column(Boolean, default=True) # Agents can toggle their availability
-    created_at = Column(DateTime, server_default=func.now()) # When the user was added
+    id: Mapped[int] = mapped_column(Integer, primary_key=True) # Unique ID for each user
+    telegram_id: Mapped[int] = mapped_column(BigInteger, unique=True, nullable=False) # Their Telegram user ID (can exceed 32 bits; the UNIQUE constraint's index serves the lookup on every update)
+    username: Mapped[Optional[str]] = mapped_column(String, nullable=True) # Their Telegram username (optional)
+    first_name: Mapped[Optional[str]] = mapped_column(String, nullable=True) # Their Telegram first name (optional)
+    is_agent: Mapped[Optional[bool]] = mapped_column(Boolean, default=False) # True if this user is a support agent
+    is_available: Mapped[Optional[bool]] = mapped_column(Boolean, default=True) # Agents can toggle their availability
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, server_default=func.now()) # When the user was added
+
+    __table_args__ = (
+        Index("ix_user_agent_avail", "is_agent", "is_available"), # Speeds up finding available agents
+    )
 
     # Relationships to other tables
-    support_requests_as_customer = relationship("SupportRequest", foreign_keys="[SupportRequest.customer_id]", back_populates="customer")
-    support_requests_as_agent = relationship("SupportRequest", foreign_keys="[SupportRequest.agent_id]", back_populates="agent")
-    messages = relationship("Message", back_populates="sender")
+    # Loading strategy: these collections grow without bound, so implicit lazy loads raise instead of
+    # silently running one query per user (N+1). Load them explicitly when needed, e.g.
+    # select(User).options(selectinload(User.support_requests_as_customer))
+    support_requests_as_customer: Mapped[List["SupportRequest"]] = relationship(foreign_keys="[SupportRequest.customer_id]", back_populates="customer", lazy="raise_on_sql")
+    support_requests_as_agent: Mapped[List["SupportRequest"]] = relationship(foreign_keys="[SupportRequest.agent_id]", back_populates="agent", lazy="raise_on_sql")
+    messages: Mapped[List["Message"]] = relationship(back_populates="sender", lazy="raise_on_sql")
+    languages: Mapped[List["AgentLanguage"]] = relationship(lazy="selectin", cascade="all, delete-orphan") # Languages an agent can handle
 
     def __repr__(self):
         return f"<User(telegram_id={self.telegram_id}, username='{self.username}', is_agent={self.is_agent})>"
 
+# AgentLanguage Model: One language an agent can handle (one row per agent and language)
+class AgentLanguage(Base):
+    __tablename__ = 'agent_languages'
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.id'), primary_key=True) # The agent
+    language: Mapped[str] = mapped_column(String(LANGUAGE_CODE_MAX_LENGTH), primary_key=True) # Language code, e.g. "en"
+
+    __table_args__ = (
+        Index("ix_agent_lang", "language", "user_id"), # Find agents for a language
+    )
+
+    def __repr__(self):
+        return f"<AgentLanguage(user_id={self.user_id}, language='{self.language}')>"
+
+# Status of a support request, stored as a small integer (cheaper to store, index and compare than text)
+class SRStatus(enum.IntEnum):
+    PENDING = 0 # Waiting for an agent to claim it
+    ASSIGNED = 1 # Claimed by an agent, conversation in progress
+    CLOSED = 2 # Finished
+
 # SupportRequest Model: Represents a customer's support conversation
 class SupportRequest(Base):
     __tablename__ = 'support_requests'
-    id = Column(Integer, primary_key=True)
-    customer_id = Column(Integer, ForeignKey('users.id'), nullable=False) # Link to the customer who opened the request
-    agent_id = Column(Integer, ForeignKey('users.id'), nullable=True) # Link to the agent assigned (null until assigned)
-    language = Column(String, nullable=False) # The language of the request (e.g., "en", "es")
-    status = Column(String, default='pending') # Status: 'pending', 'assigned', 'closed'
-    created_at = Column(DateTime, server_default=func.now()) # When the request was created
-    assigned_at = Column(DateTime, nullable=True) # When an agent was assigned
-    closed_at = Column(DateTime, nullable=True) # When the request was closed
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    customer_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.id'), nullable=False) # Link to the customer who opened the request
+    agent_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey('users.id'), nullable=True) # Link to the agent assigned (null until assigned)
+    language: Mapped[str] = mapped_column(String, nullable=False) # The language of the request (e.g., "en", "es")
+    status: Mapped[int] = mapped_column(SmallInteger, default=int(SRStatus.PENDING), nullable=False) # One of SRStatus
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, server_default=func.now()) # When the request was created
+    assigned_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True) # When an agent was assigned
+    closed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True) # When the request was closed
+    # Latest "Name: text" lines, shown to the agent who claims the request
+    # Only loaded when asked for with undefer(SupportRequest.history_preview), so request listings stay small
+    history_preview: Mapped[Optional[str]] = mapped_column(Text, nullable=True, deferred=True, deferred_raiseload=True)
+
+    __table_args__ = (
+        Index("ix_sr_status_language", "status", "language"), # Pending requests in a given language
+        Index("ix_sr_agent_status", "agent_id", "status"), # An agent's assigned requests
+        Index("ix_sr_customer_status", "customer_id", "status"), # A customer's active request
+        # Pending requests only: stays small as assigned and closed requests pile up (dispatch queue, oldest first)
+        Index("ix_sr_pending", "language", "created_at",
+              postgresql_where=text("status = 0"), # SRStatus.PENDING
+              sqlite_where=text("status = 0")),
+    )
 
     # Relationships
-    customer = relationship("User", foreign_keys=[customer_id], back_populates="support_requests_as_customer")
-    agent = relationship("User", foreign_keys=[agent_id], back_populates="support_requests_as_agent")
-    messages = relationship("Message", back_populates="support_request", cascade="all, delete-orphan")
+    customer: Mapped["User"] = relationship(foreign_keys=[customer_id], back_populates="support_requests_as_customer")
+    agent: Mapped[Optional["User"]] = relationship(foreign_keys=[agent_id], back_populates="support_requests_as_agent")
+    # A transcript can be long, so it is never loaded implicitly; use selectinload(SupportRequest.messages) when it's needed
+    messages: Mapped[List["Message"]] = relationship(back_populates="support_request", cascade="all, delete-orphan", lazy="raise_on_sql")
 
     def __repr__(self):
-        return f"<SupportRequest(id={self.id}, customer_id={self.customer_id}, status='{self.status}')>"
+        # Fall back to the raw value, e.g. None before the row is flushed
+        status = SRStatus(self.status).name.lower() if self.status in SRStatus.__members__.values() else self.status
+        return f"<SupportRequest(id={self.id}, customer_id={self.customer_id}, status='{status}')>"
 
 # Message Model: Represents individual messages within a support request
 class Message(Base):
     __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True)
-    support_request_id = Column(Integer, ForeignKey('support_requests.id'), nullable=False) # Link to the parent support request
-    sender_id = Column(Integer, ForeignKey('users.id'), nullable=False) # The actual sender of the message (customer or agent)
-    text = Column(Text, nullable=False) # The content of the message
-    timestamp = Column(DateTime, server_default=func.now()) # When the message was sent
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True) # 64-bit, message volume dominates (SQLite only auto-increments INTEGER keys)
+    support_request_id: Mapped[int] = mapped_column(Integer, ForeignKey('support_requests.id'), nullable=False) # Link to the parent support request
+    sender_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.id'), nullable=False) # The actual sender of the message (customer or agent)
+    text: Mapped[str] = mapped_column(String(MESSAGE_MAX_LENGTH), nullable=False) # The content of the message (Telegram caps it at 4096 characters)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=False, server_default=func.now()) # When the message was sent
 
-    # Relationships
-    support_request = relationship("SupportRequest", back_populates="messages")
-    sender = relationship("User", back_populates="messages")
+    __table_args__ = (
+        # A request's messages in order; on PostgreSQL the sender is stored in the index too, so transcripts skip
+        # most heap lookups ("text" is left out: long messages would exceed the B-tree entry size limit)
+        Index("ix_msg_sr_ts_cover", "support_request_id", "timestamp", postgresql_include=["sender_id"]),
+        # On PostgreSQL the table is split into monthly partitions (see migration 0007 and create_message_partitions()).
+        # Its primary key there is (id, timestamp), as partitioning requires, so the schema comes from the migrations.
+        # Queries that read messages should filter on timestamp (e.g. timestamp >= the request's created_at, since a
+        # request's messages are never older than the request) so they only visit the relevant partitions.
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+    # Relationships (lazy by default; use joinedload(Message.sender) when loading many messages)
+    support_request: Mapped["SupportRequest"] = relationship(back_populates="messages")
+    sender: Mapped["User"] = relationship(back_populates="messages")
 
     def __repr__(self):
         return f"<Message(id={self.id}, sender_id={self.sender_id}, support_request_id={self.support_request_id})>"
 
-# Setup the database engine and session
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# AvailableAgent Model: Read-only view of (available agent, language) pairs, for fast agent lookup
+# Backed by the "available_agents_by_language" materialized view on PostgreSQL (see migrations 0002 and 0003),
+# so it is never created by init_db() and must be refreshed with refresh_agent_view() after agent changes
+class AvailableAgent(Base):
+    __tablename__ = 'available_agents_by_language'
+    __table_args__ = {"info": {"is_view": True}}
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey('users.id'), primary_key=True) # The available agent
+    language: Mapped[str] = mapped_column(String, primary_key=True) # One language the agent can handle
+
+    def __repr__(self):
+        return f"<AvailableAgent(user_id={self.user_id}, language='{self.language}')>"
+
+# Helper to rebuild the available agents view after an agent's availability or languages change
+# CONCURRENTLY lets agent lookups keep reading the old rows while the new ones are computed
+async def refresh_agent_view(session):
+    if session.get_bind().dialect.name == "postgresql": # The view only exists on PostgreSQL
+        await session.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY available_agents_by_language"))
+        await session.commit()
+
+_agent_view_refresh_now = None # Event that starts the upcoming view refresh early, if one is scheduled
+_agent_view_refresh_tasks = set() # Running refresh tasks (asyncio only keeps weak references to them)
+
+# Helper to refresh the available agents view a few seconds after an agent's availability or languages change
+# Changes made while a refresh is waiting are picked up by that same refresh, so a burst of toggles costs one refresh
+def schedule_agent_view_refresh():
+    global _agent_view_refresh_now
+    if async_engine.dialect.name != "postgresql" or _agent_view_refresh_now is not None:
+        return # No view to refresh, or the refresh that is already scheduled will include this change
+    _agent_view_refresh_now = asyncio.Event()
+    task = asyncio.create_task(_refresh_agent_view_later(_agent_view_refresh_now))
+    _agent_view_refresh_tasks.add(task)
+    task.add_done_callback(_agent_view_refresh_tasks.discard)
+
+async def _refresh_agent_view_later(now):
+    global _agent_view_refresh_now
+    try:
+        await asyncio.wait_for(now.wait(), timeout=AGENT_VIEW_REFRESH_DELAY)
+    except asyncio.TimeoutError:
+        pass
+    _agent_view_refresh_now = None # Changes from here on schedule a new refresh
+    try:
+        async with AsyncSessionLocal() as session:
+            await refresh_agent_view(session)
+    except Exception:
+        logger.exception("Failed to refresh the available agents view")
+
+# Helper to run any scheduled view refresh right away and wait for it (e.g. before shutting down)
+async def flush_agent_view_refresh():
+    if _agent_view_refresh_now is not None:
+        _agent_view_refresh_now.set()
+    await asyncio.gather(*_agent_view_refresh_tasks)
+
+# The user details needed on every message, kept in memory for a short while so most messages skip the users query
+CachedUser = namedtuple("CachedUser", ["id", "telegram_id", "username", "first_name", "is_agent"])
+_user_by_telegram_id = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Reverse index of User.id -> User.telegram_id, so relaying a message doesn't need a SELECT to find the other party's chat.
+# Both IDs are fixed once a user exists, so these entries never need invalidating.
+_telegram_id_by_user_id = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Helper to remember a user (called whenever a user row is loaded anyway); returns their cached details
+def cache_user(user):
+    cached = CachedUser(*(getattr(user, field) for field in CachedUser._fields))
+    _user_by_telegram_id[cached.telegram_id] = cached
+    _telegram_id_by_user_id[cached.id] = cached.telegram_id
+    return cached
+
+# Helper to drop a user from the cache after changing them, so the next message sees the change
+def forget_cached_user(telegram_id):
+    _user_by_telegram_id.pop(telegram_id, None)
+
+# Helper to get a user's details by Telegram ID, hitting the database only on a cache miss (None if there's no such user)
+# The result is read-only: to change a user, load them with get_user() and call forget_cached_user() after committing
+async def get_cached_user(session, telegram_id):
+    cached = _user_by_telegram_id.get(telegram_id)
+    if cached is None:
+        # Only the cached columns are selected, which also skips loading the user's languages
+        row = (await session.execute(select(*(getattr(User, field) for field in CachedUser._fields)).where(
+            User.telegram_id == telegram_id
+        ))).first()
+        if row is not None:
+            cached = cache_user(row)
+    return cached
+
+# Helper to look up a user's Telegram ID (their chat ID) by internal ID, hitting the database only on a cache miss
+async def get_telegram_id_cached(session, user_id):
+    telegram_id = _telegram_id_by_user_id.get(user_id)
+    if telegram_id is None:
+        telegram_id = await session.scalar(select(User.telegram_id).where(User.id == user_id))
+        if telegram_id is not None:
+            _telegram_id_by_user_id[user_id] = telegram_id
+    return telegram_id
+
+# Statements run on nearly every update, built once and cached by SQLAlchemy so each call skips compiling the SQL
+_get_user_stmt = lambda_stmt(lambda: select(User).where(User.telegram_id == bindparam("tid")))
+# The status is written into the SQL text rather than sent as a parameter, so PostgreSQL can match it
+# against the ix_sr_pending partial index even when the statement is prepared once and reused
+_is_pending = SupportRequest.status == literal(int(SRStatus.PENDING), literal_execute=True)
+# The customer comes from the same query (JOIN); their agent languages aren't needed, so they aren't loaded
+_pending_requests_stmt = lambda_stmt(lambda: select(SupportRequest).options(joinedload(SupportRequest.customer).raiseload(User.languages)).where(
+    _is_pending,
+    SupportRequest.language.in_(bindparam("langs", expanding=True))
+).order_by(SupportRequest.created_at)) # Oldest first, served by the ix_sr_pending partial index
+
+# Helper to find a user by Telegram ID (None if they haven't used the bot yet)
+async def get_user(session, telegram_id):
+    return await session.scalar(_get_user_stmt, {"tid": telegram_id})
+
+# Helper to list the pending requests in any of the given languages, oldest first (with their customers loaded)
+async def pending_requests(session, languages):
+    return (await session.scalars(_pending_requests_stmt, {"langs": list(languages)})).all()
+
+# Helper to format a message as a line of a request's history preview
+def history_preview_line(sender_name, text):
+    return f"{sender_name}: {text}\n"
+
+# Helper to add a message to a request's history preview in a single UPDATE, dropping the oldest text beyond
+# HISTORY_PREVIEW_MAX_LENGTH characters so the column stays small however long the conversation gets
+async def append_history_preview(session, support_request_id, sender_name, text):
+    preview = func.coalesce(SupportRequest.history_preview, "") + history_preview_line(sender_name, text)
+    if session.get_bind().dialect.name == "sqlite":
+        preview = func.substr(preview, -HISTORY_PREVIEW_MAX_LENGTH) # SQLite has no right(); a negative start counts from the end
+    else:
+        preview = func.right(preview, HISTORY_PREVIEW_MAX_LENGTH)
+    await session.execute(
+        update(SupportRequest).where(SupportRequest.id == support_request_id).values(history_preview=preview)
+    )
+
+# Helpers to move a support request to a new status in a single UPDATE statement
+# The timestamps come from the database clock (now()), so no row has to be read back first
+# Assigning only succeeds while the request is still pending, so two agents can never both claim it;
+# returns True if this agent got the request
+async def assign_support_request(session, support_request_id, agent_id):
+    result = await session.execute(
+        update(SupportRequest)
+        .where(SupportRequest.id == support_request_id, SupportRequest.status == SRStatus.PENDING)
+        .values(agent_id=agent_id, status=SRStatus.ASSIGNED, assigned_at=func.now())
+    )
+    return result.rowcount == 1
+
+async def close_support_request(session, support_request_id):
+    await session.execute(
+        update(SupportRequest)
+        .where(SupportRequest.id == support_request_id)
+        .values(status=SRStatus.CLOSED, closed_at=func.now())
+    )
+
+# Helper to flip an agent's availability in a single UPDATE, so two toggles at once can't both read the same old value
+# Returns the new availability
+async def toggle_agent_availability(session, user_id):
+    return await session.scalar(
+        update(User).where(User.id == user_id).values(is_available=~User.is_available).returning(User.is_available)
+    )
+
+# Helper to save many messages at once, without building an ORM object per row
+# e.g. with session_scope() as db: bulk_save_messages(db, [{"support_request_id": 1, "sender_id": 2, "text": "Hi"}, ...])
+# Rows are written and committed in chunks of batch_size, so a long import keeps its progress and its transactions stay short
+# (SQLAlchemy splits each chunk into INSERT statements that fit the backend's parameter limit)
+def bulk_save_messages(session, dicts, batch_size=1000):
+    for start in range(0, len(dicts), batch_size):
+        session.execute(insert(Message), dicts[start:start + batch_size]) # SQLAlchemy 2.0 ORM bulk INSERT
+        session.commit()
+
+# Column order of the rows given to copy_messages()
+_COPY_MESSAGE_COLUMNS = ("support_request_id", "sender_id", "text", "timestamp")
+
+# File-like object that turns rows into CSV lines only as COPY reads them, so imports of any size use little memory
+class _CsvRowStream(io.TextIOBase):
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            line = io.StringIO()
+            csv.writer(line, lineterminator="\n").writerow(row) # None and "" are both written as an empty field
+            self._buffer += line.getvalue()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+# Helper to import a large message history, e.g. when migrating from another support tool (not for the bot itself)
+# Rows are (support_request_id, sender_id, text, timestamp) tuples; any iterable works, including a generator
+# PostgreSQL loads them with a single COPY, which is far faster than INSERTs; other databases use bulk_save_messages()
+def copy_messages(engine, rows, batch_size=1000):
+    if engine.dialect.name != "postgresql":
+        rows = iter(rows)
+        with Session(engine) as session:
+            while batch := [dict(zip(_COPY_MESSAGE_COLUMNS, row)) for row in islice(rows, batch_size)]:
+                bulk_save_messages(session, batch, batch_size)
+        return
+    columns = ", ".join(_COPY_MESSAGE_COLUMNS)
+    raw = engine.raw_connection() # COPY isn't available through SQLAlchemy, only through the driver itself
+    try:
+        cursor = raw.cursor()
+        if engine.dialect.driver == "psycopg2":
+            # Empty fields load as NULL, except in "text", where they are empty messages (the column is NOT NULL)
+            cursor.copy_expert(f"COPY messages ({columns}) FROM STDIN WITH (FORMAT CSV, FORCE_NOT_NULL (text))", _CsvRowStream(rows))
+        else: # psycopg 3 streams rows through its own COPY object
+            with cursor.copy(f"COPY messages ({columns}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close() # Returns the connection to the pool
+
+# Helper to create the monthly partitions of the messages table ahead of time (PostgreSQL only)
+# Run it regularly, e.g. from a daily cron job: python -c "from database import create_message_partitions; create_message_partitions()"
+def create_message_partitions(months_ahead=3):
+    if engine.dialect.name != "postgresql":
+        return
+    month = date.today().replace(day=1)
+    with engine.begin() as conn:
+        for _ in range(months_ahead + 1):
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            conn.exec_driver_sql(
+                f"CREATE TABLE IF NOT EXISTS messages_p{month:%Y%m} PARTITION OF messages "
+                f"FOR VALUES FROM ('{month}') TO ('{next_month}') "
+                f"WITH (toast_tuple_target = {MESSAGE_TOAST_TUPLE_TARGET})"
+            )
+            month = next_month
+
+# Setup the database engines and sessions
+_url = make_url(DATABASE_URL)
+_backend = _url.get_backend_name()
+if _backend == "sqlite":
+    # SQLite has no server to pool connections to; share one connection across the bot's threads
+    _engine_options = {
+        "connect_args": {"check_same_thread": False},
+        "poolclass": StaticPool,
+    }
+    _async_engine_options = {}
+else:
+    # Reuse warm connections and detect dead ones before handing them out
+    _engine_options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": True,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    _async_engine_options = dict(_engine_options)
+    if _url.get_driver_name() == "psycopg2":
+        # psycopg2 sends executemany() one row at a time unless told to batch
+        _engine_options["executemany_mode"] = "values_plus_batch"
+        _engine_options["executemany_batch_page_size"] = 500
+
+# Synchronous engine, used by init_db() and command-line tools
+# Multi-row INSERTs are collapsed into a single "INSERT ... VALUES (...), (...)" of up to 1000 rows
+engine = create_engine(DATABASE_URL, insertmanyvalues_page_size=1000, future=True, **_engine_options)
+# Objects stay readable after commit instead of being reloaded from the database on next access
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# Helper to run a unit of work in a session: commits on success, rolls back on error and always closes it
+# e.g. with session_scope() as db: db.add(user)
+@contextmanager
+def session_scope():
+    session = SessionLocal()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close() # Returns the connection to the pool
+
+# Asynchronous engine, used by the bot's handlers so queries don't block the event loop
+# The same database is reached through an asyncio driver, e.g. "postgresql://..." becomes "postgresql+asyncpg://..."
+_ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+ASYNC_DATABASE_URL = _url.set(drivername=f"{_backend}+{_ASYNC_DRIVERS[_backend]}") if _backend in _ASYNC_DRIVERS else _url
+async_engine = create_async_engine(ASYNC_DATABASE_URL, insertmanyvalues_page_size=1000, **_async_engine_options)
+# Objects stay readable after commit; reloading expired attributes would need an extra awaited query
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Helper to tune every new SQLite connection: write-ahead logging lets readers work alongside a writer,
+# and commits no longer wait for a full disk sync
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL") # Still safe against corruption in WAL mode
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456") # Read the database file through a 256 MB memory map
+    cursor.execute("PRAGMA foreign_keys=ON") # SQLite ignores FOREIGN KEY constraints unless asked
+    cursor.close()
+
+if _backend == "sqlite":
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas) # Async engines fire their events on the wrapped sync engine
 
-# Function to create all tables in the database
+# Function to create or upgrade the database schema (same as "alembic upgrade head")
+# An empty SQLite database gets the tables straight from the models; every other database is migrated, so an
+# existing one is brought up to date instead of being left as it is. Safe to run repeatedly.
 def init_db():
-    Base.metadata.create_all(bind=engine)
-    print("Database initialized.")
+    from alembic import command
+    from alembic.config import Config
+    alembic_cfg = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+    with engine.connect() as conn: # Fails early with a clear error if the database is unreachable
+        existing_tables = set(inspect(conn).get_table_names())
+    if engine.dialect.name == "sqlite" and not existing_tables:
+        tables = [table for table in Base.metadata.sorted_tables if not table.info.get("is_view")] # Views come from migrations
+        Base.metadata.create_all(bind=engine, tables=tables)
+        command.stamp(alembic_cfg, "head") # The new tables already match the latest migration
+        print(f"Database initialized. Tables: {', '.join(table.name for table in tables)}")
+        return
+    if existing_tables and "alembic_version" not in existing_tables:
+        if "agent_languages" in existing_tables:
+            raise RuntimeError(
+                "The database has tables but no migration history, so its schema can't be determined. "
+                "Run \"alembic stamp <revision>\" with the revision it matches, then \"alembic upgrade head\"."
+            )
+        command.stamp(alembic_cfg, "0001") # Created by the original init_db(), before the migrations existed
+    # Partitioned tables, materialized views and data conversions can only be done by the migrations
+    command.upgrade(alembic_cfg, "head")
+    print("Database initialized with Alembic migrations.")
 
 # This block ensures init_db() is called only when database.py is run directly
 if __name__ == "__main__":
@@ -3,16 +3,32 @@ import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup # For Telegram objects
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    filters, ContextTypes # For handling different types of updates
+    filters, ContextTypes, # For handling different types of updates
+    AIORateLimiter, # For staying within Telegram's flood limits
+    PicklePersistence, PersistenceInput # For keeping conversation state across restarts
 )
-from sqlalchemy.orm import Session # For database session management
-from sqlalchemy import or_, and_ # For advanced database queries
-from sqlalchemy.sql import func # For database functions like func.now()
+from sqlalchemy.ext.asyncio import AsyncSession # For async database session management
+from sqlalchemy.orm import joinedload, undefer # For choosing how related rows and columns are loaded
+from sqlalchemy import select, or_, and_ # For building (advanced) database queries
+from sqlalchemy.exc import IntegrityError # Raised when a write breaks a constraint, e.g. a duplicate telegram_id
 import asyncio # For asynchronous operations
+import os # For reading deployment settings from environment variables
+import functools # For writing decorators
+import re # For matching button data
+from urllib.parse import urlparse # For reading the path of the webhook URL
+try:
+    import uvloop # Faster drop-in event loop (optional; not available on Windows)
+except ImportError:
+    uvloop = None
 
 # Import our configurations and database models
 from config import TELEGRAM_BOT_TOKEN
-from database import SessionLocal, User, SupportRequest, Message, init_db
+from database import (
+    AsyncSessionLocal, async_engine, User, AgentLanguage, SupportRequest, SRStatus, Message, AvailableAgent,
+    LANGUAGE_CODE_MAX_LENGTH, HISTORY_PREVIEW_MAX_LENGTH, CachedUser,
+    assign_support_request, close_support_request, toggle_agent_availability, history_preview_line, append_history_preview,
+    get_user, pending_requests, cache_user, forget_cached_user, get_cached_user, get_telegram_id_cached, schedule_agent_view_refresh, flush_agent_view_refresh
+)
 
 # Configure logging: This helps you see what your bot is doing in the terminal
 logging.basicConfig(
@@ -21,48 +37,80 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- Helper Functions for Database Operations ---
-# This function provides a database session for each handler
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db # 'yield' makes this a generator, allowing us to use it with 'async for'
-    finally:
-        db.close() # Ensure the session is closed after use
+# Webhook settings (optional): when WEBHOOK_URL is set, Telegram pushes updates to this bot instead of the bot polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public HTTPS address Telegram sends updates to, e.g. https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0") # Local address the webhook server binds to
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443")) # Local port the webhook server listens on
+# Secret Telegram sends with every webhook update; updates without it are rejected, so nobody else can post fake ones
+# Required in webhook mode: 1-256 characters, only A-Z, a-z, 0-9, "_" and "-"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# File (optional) where customers' conversation state is saved, so a restart doesn't interrupt someone choosing a language
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE")
+
+# Button data patterns, compiled once; the captured part is read from context.matches in the handlers
+LANG_RE = re.compile(r"^lang_(\w+)$") # e.g. "lang_en"
+BID_RE = re.compile(r"^bid_(\d+)$") # e.g. "bid_42"
+
+# Language selection buttons shown to customers (built once; keyboards can't be changed after creation)
+LANGUAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("English 🇬🇧", callback_data="lang_en")],
+    [InlineKeyboardButton("Español 🇪🇸", callback_data="lang_es")],
+    [InlineKeyboardButton("Français 🇫🇷", callback_data="lang_fr")],
+    [InlineKeyboardButton("Deutsch 🇩🇪", callback_data="lang_de")],
+])
+
+# Helper to build the "Bid" button for a request
+# Cached, so the same request shown to many agents (or listed again in /view_requests) reuses one keyboard
+@functools.lru_cache(maxsize=1024)
+def bid_markup(request_id: int, label: str = "Bid") -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=f"bid_{request_id}")]])
 
+# --- Helper Functions for Database Operations ---
 # Decorator to automatically manage database sessions for our async handlers
+# Queries are awaited, so the event loop keeps serving other updates during database round-trips
+# The session is passed to the handler as its third argument; it belongs to this one update, so it isn't kept in user_data
 def db_session_decorator(func):
+    @functools.wraps(func) # Keep the handler's name for logs and tracebacks
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        # We need to manually iterate the generator and then close it
-        db_generator = get_db()
-        db = next(db_generator) # Get the session from the generator
-
-        context.user_data['_db'] = db # Store it in context for easy access
-        try:
-            await func(update, context) # Run the actual handler function
-        finally:
-            # Ensure the session is closed, even if an error occurs in the handler
-            db_generator.close()
-            if '_db' in context.user_data: # Clean up after use
-                del context.user_data['_db']
+        # The session is closed when the block exits, even if an error occurs in the handler
+        async with AsyncSessionLocal() as db:
+            try:
+                await func(update, context, db) # Run the actual handler function
+            except Exception:
+                await db.rollback() # Discard half-applied writes before the error reaches the error handler
+                raise
     return wrapper
+
 # Helper to get an existing user or create a new one in the database
-async def get_or_create_user(db: Session, telegram_id: int, username: str, first_name: str) -> User:
-    user = db.query(User).filter_by(telegram_id=telegram_id).first()
+async def get_or_create_user(db: AsyncSession, telegram_id: int, username: str, first_name: str) -> User:
+    user = await get_user(db, telegram_id)
     if not user:
         user = User(telegram_id=telegram_id, username=username, first_name=first_name)
         db.add(user)
-        db.commit() # Save the new user to the database
-        db.refresh(user) # Refresh the object to get its new ID
-        logger.info(f"New user created: {user}")
+        try:
+            await db.commit() # Save the new user to the database
+        except IntegrityError: # Another update from the same user, handled at the same time, created them first
+            await db.rollback()
+            user = await get_user(db, telegram_id)
+        else:
+            await db.refresh(user) # Refresh the object to get its new ID
+            logger.info(f"New user created: {user}")
+    cache_user(user) # Later messages and relays can use this user's details without a query
     return user
 
+# Helper to get a user's details from the cache, creating the user on their first message
+async def get_or_create_cached_user(db: AsyncSession, telegram_id: int, username: str, first_name: str) -> CachedUser:
+    cached = await get_cached_user(db, telegram_id)
+    if cached is None: # First time we see this user
+        cached = cache_user(await get_or_create_user(db, telegram_id, username, first_name))
+    return cached
+
 # --- Bot Commands and Handlers ---
 
 # /start command handler
 @db_session_decorator
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db'] # Get the database session
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     user = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if user.is_agent: # If the user is an agent
@@ -72,25 +120,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
     else: # If the user is a customer
         # Offer language selection using inline keyboard buttons
-        keyboard = [
-            [InlineKeyboardButton("English 🇬🇧", callback_data="lang_en")],
-            [InlineKeyboardButton("Español 🇪🇸", callback_data="lang_es")],
-            [InlineKeyboardButton("Français 🇫🇷", callback_data="lang_fr")],
-            [InlineKeyboardButton("Deutsch 🇩🇪", callback_data="lang_de")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Welcome to Support! Please select your preferred language:", reply_markup=reply_markup)
+        await update.message.reply_text("Welcome to Support! Please select your preferred language:", reply_markup=LANGUAGE_MARKUP)
         # Store state to know what to expect next from the customer
         context.user_data['state'] = 'awaiting_language_selection' 
         logger.info(f"Customer {user.telegram_id} initiated support via /start.")
 
 # Handler for language selection buttons (callback queries starting with 'lang_')
 @db_session_decorator
-async def handle_language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     query = update.callback_query # Get the callback query object
     await query.answer() # Acknowledge the callback query (removes loading spinner from button)
 
-    db: Session = context.user_data['_db']
     user = await get_or_create_user(db, query.from_user.id, query.from_user.username, query.from_user.first_name)
 
     # Check if the user is in the correct state to select a language
@@ -98,7 +138,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text("Please start a new support request with /start if you want to select a language again.")
         return
 
-    selected_language = query.data.split('_')[1] # Extract language code (e.g., 'en' from 'lang_en')
+    selected_language = context.matches[0].group(1) # Language code matched by LANG_RE (e.g., 'en' from 'lang_en')
     context.user_data['customer_language'] = selected_language # Store selected language
 
     await query.edit_message_text(f"You've selected {selected_language.upper()}. Please describe your issue.")
@@ -107,19 +147,19 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
 
 # Handler for regular text messages from customers
 @db_session_decorator
-async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
-    customer = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
+async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
+    customer = await get_or_create_cached_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if customer.is_agent: # If an agent sends a message that's not a command
-        await handle_agent_message(update, context) # Delegate to agent message handler
+        await handle_agent_message(update, context, db) # Delegate to agent message handler
         return
 
     # Check if this customer already has an active support request
-    active_request = db.query(SupportRequest).filter(
+    # Only the columns used below are selected: a plain row, no ORM object or loading of related messages
+    active_request = (await db.execute(select(SupportRequest.id, SupportRequest.status, SupportRequest.agent_id).where(
         SupportRequest.customer_id == customer.id,
-        or_(SupportRequest.status == 'pending', SupportRequest.status == 'assigned') # Request is either waiting or assigned
-    ).first()
+        or_(SupportRequest.status == SRStatus.PENDING, SupportRequest.status == SRStatus.ASSIGNED) # Request is either waiting or assigned
+    ).limit(1))).first()
 
     if not active_request: # If no active request, this is likely the first issue description
         if context.user_data.get('state') == 'awaiting_customer_issue' and 'customer_language' in context.user_data:
@@ -128,11 +168,12 @@ async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_
             support_request = SupportRequest(
                 customer_id=customer.id,
                 language=language,
-                status='pending'
+                status=SRStatus.PENDING,
+                # Start the history shown to the agent who claims the request
+                history_preview=history_preview_line(customer.first_name or customer.username, update.message.text)[-HISTORY_PREVIEW_MAX_LENGTH:]
             )
             db.add(support_request)
-            db.commit()
-            db.refresh(support_request)
+            await db.flush() # Sends the INSERT to get the request ID, without committing yet
 
             # Log the initial customer message in the database
             msg = Message(
@@ -141,24 +182,24 @@ async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_
                 text=update.message.text
             )
             db.add(msg)
-            db.commit()
+            await db.commit() # One commit saves both the request and its first message
 
             await update.message.reply_text("Thank you. We are looking for an available agent to assist you.")
             logger.info(f"New support request created: {support_request.id} for customer {customer.telegram_id}.")
 
             # Notify eligible agents about the new request
-            await notify_agents_about_new_request(db, support_request, context.application)
-            context.user_data['state'] = 'request_pending' # Update customer state
+            await notify_agents_about_new_request(db, support_request, customer, update.message.text, context.application)
+            context.user_data.clear() # The request now lives in the database, so there's no customer state left to keep
         else:
             await update.message.reply_text("Please use /start to begin a new support request and select your language.")
     else: # If there's an active request
-        if active_request.status == 'assigned': # If an agent is assigned, forward message to agent
-            agent = db.query(User).get(active_request.agent_id)
-            if agent:
+        if active_request.status == SRStatus.ASSIGNED: # If an agent is assigned, forward message to agent
+            agent_telegram_id = await get_telegram_id_cached(db, active_request.agent_id)
+            if agent_telegram_id:
                 try:
                     # Forward customer's message to the assigned agent
                     await context.application.bot.send_message(
-                        chat_id=agent.telegram_id,
+                        chat_id=agent_telegram_id,
                         text=f"From customer {customer.first_name or customer.username}:\n{update.message.text}"
                     )
                     # Log the message
@@ -168,10 +209,10 @@ async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_
                         text=update.message.text
                     )
                     db.add(msg)
-                    db.commit()
-                    logger.info(f"Message from customer {customer.telegram_id} forwarded to agent {agent.telegram_id}.")
+                    await db.commit()
+                    logger.info(f"Message from customer {customer.telegram_id} forwarded to agent {agent_telegram_id}.")
                 except Exception as e:
-                    logger.error(f"Failed to forward message from customer {customer.telegram_id} to agent {agent.telegram_id}: {e}")
+                    logger.error(f"Failed to forward message from customer {customer.telegram_id} to agent {agent_telegram_id}: {e}")
                     await update.message.reply_text("There was an error forwarding your message. Please try again.")
             else:
                 await update.message.reply_text("Assigned agent not found. Please wait, we are trying to reconnect you.")
@@ -184,30 +225,31 @@ async def handle_customer_message(update: Update, context: ContextTypes.DEFAULT_
                 text=update.message.text
             )
             db.add(msg)
-            db.commit()
+            # Add it to the history the claiming agent will see; saved in the same commit as the message
+            await append_history_preview(db, active_request.id, customer.first_name or customer.username, update.message.text)
+            await db.commit()
 
 # Handler for regular text messages from agents (when assigned to a chat)
-@db_session_decorator
-async def handle_agent_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
-    agent = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
+# Called by handle_customer_message with its session, so it isn't decorated itself
+async def handle_agent_message(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
+    agent = await get_or_create_cached_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if not agent.is_agent:
         return # Should not happen if correctly delegated from handle_customer_message
 
-    # Find the active request this agent is currently assigned to
-    active_request = db.query(SupportRequest).filter(
+    # Find the active request this agent is currently assigned to (just the columns needed to relay the message)
+    active_request = (await db.execute(select(SupportRequest.id, SupportRequest.customer_id).where(
         SupportRequest.agent_id == agent.id,
-        SupportRequest.status == 'assigned'
-    ).first()
+        SupportRequest.status == SRStatus.ASSIGNED
+    ).limit(1))).first()
 
     if active_request:
-        customer = db.query(User).get(active_request.customer_id)
-        if customer:
+        customer_telegram_id = await get_telegram_id_cached(db, active_request.customer_id)
+        if customer_telegram_id:
             try:
                 # Forward agent's message to the customer
                 await context.application.bot.send_message(
-                    chat_id=customer.telegram_id,
+                    chat_id=customer_telegram_id,
                     text=f"From Agent {agent.first_name or agent.username}:\n{update.message.text}"
                 )
                 # Log the message
@@ -217,10 +259,10 @@ async def handle_agent_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     text=update.message.text
                 )
                 db.add(msg)
-                db.commit()
-                logger.info(f"Message from agent {agent.telegram_id} forwarded to customer {customer.telegram_id}.")
+                await db.commit()
+                logger.info(f"Message from agent {agent.telegram_id} forwarded to customer {customer_telegram_id}.")
             except Exception as e:
-                logger.error(f"Failed to forward message from agent {agent.telegram_id} to customer {customer.telegram_id}: {e}")
+                logger.error(f"Failed to forward message from agent {agent.telegram_id} to customer {customer_telegram_id}: {e}")
                 await update.message.reply_text("There was an error forwarding your message. Please try again.")
         else:
             await update.message.reply_text("Assigned customer not found. This conversation might be stale.")
@@ -228,22 +270,24 @@ async def handle_agent_message(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("You are not currently assigned to any active support request. Use /view_requests.")
 
 # Function to notify eligible agents about a new pending support request
-async def notify_agents_about_new_request(db: Session, support_request: SupportRequest, application: Application):
-    customer = db.query(User).get(support_request.customer_id)
-    # Get the first message from the customer for context
-    initial_message = db.query(Message).filter_by(
-        support_request_id=support_request.id,
-        sender_id=customer.id
-    ).order_by(Message.timestamp).first()
-
-    # Find all available agents who are proficient in the request's language
-    eligible_agents = db.query(User).filter(
-        User.is_agent == True,
-        User.is_available == True,
-        User.language_proficiencies.like(f"%{support_request.language}%") # Simple check if language is in their proficiencies string
-    ).all()
-
-    if not eligible_agents:
+# The caller passes the customer and their first message, which it has just saved, so they aren't queried again
+async def notify_agents_about_new_request(db: AsyncSession, support_request: SupportRequest, customer: CachedUser, initial_message_text: str, application: Application):
+    # Find all available agents who are proficient in the request's language (only their chat IDs are needed)
+    if db.get_bind().dialect.name == "postgresql":
+        # Indexed lookup in the available_agents_by_language materialized view
+        agent_chat_ids = (await db.scalars(select(User.telegram_id).join(AvailableAgent, AvailableAgent.user_id == User.id).where(
+            AvailableAgent.language == support_request.language
+        ))).all()
+    else:
+        agent_chat_ids = (await db.scalars(select(User.telegram_id).join(AgentLanguage, AgentLanguage.user_id == User.id).where(
+            User.is_agent == True,
+            User.is_available == True,
+            AgentLanguage.language == support_request.language # Indexed lookup in the agent_languages table
+        ))).all()
+    # End the read-only transaction so the pooled connection isn't held while the messages are sent
+    await db.commit()
+
+    if not agent_chat_ids:
         logger.warning(f"No available agents for language {support_request.language}.")
         await application.bot.send_message(
             chat_id=customer.telegram_id,
@@ -252,96 +296,92 @@ async def notify_agents_about_new_request(db: Session, support_request: SupportR
         return
 
     # Create a "Bid" button for agents
-    keyboard = [[InlineKeyboardButton("Bid for this Request", callback_data=f"bid_{support_request.id}")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = bid_markup(support_request.id, "Bid for this Request")
 
-    # Send notification to each eligible agent
-    for agent in eligible_agents:
-        try:
-            await application.bot.send_message(
-                chat_id=agent.telegram_id,
-                text=(f"🚨 New Support Request! 🚨\n\n"
-                      f"Customer: {customer.first_name or customer.username} (ID: {customer.telegram_id})\n"
-                      f"Language: {support_request.language.upper()}\n"
-                      f"Initial Query: \"{initial_message.text[:100]}...\"" if initial_message else "No initial message."
-                      ),
-                reply_markup=reply_markup
-            )
-            logger.info(f"Notified agent {agent.telegram_id} about request {support_request.id}.")
-        except Exception as e:
-            logger.error(f"Failed to notify agent {agent.telegram_id}: {e}")
+    text = (f"🚨 New Support Request! 🚨\n\n"
+            f"Customer: {customer.first_name or customer.username} (ID: {customer.telegram_id})\n"
+            f"Language: {support_request.language.upper()}\n"
+            f"Initial Query: \"{initial_message_text[:100]}...\"")
+
+    # Send the notification to all eligible agents at once, so the fan-out takes about one Telegram round-trip
+    results = await asyncio.gather(
+        *(application.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup) for chat_id in agent_chat_ids),
+        return_exceptions=True # One failed send doesn't cancel the others
+    )
+    for chat_id, result in zip(agent_chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to notify agent {chat_id}: {result}")
+        else:
+            logger.info(f"Notified agent {chat_id} about request {support_request.id}.")
 
 # Handler for agent bidding on a request
 @db_session_decorator
-async def handle_bid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_bid(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     query = update.callback_query
     await query.answer() # Acknowledge the button press
 
-    db: Session = context.user_data['_db']
     agent = await get_or_create_user(db, query.from_user.id, query.from_user.username, query.from_user.first_name)
 
     if not agent.is_agent:
         await query.edit_message_text("You are not authorized to bid for support requests.")
         return
 
-    request_id = int(query.data.split('_')[1]) # Extract request ID from callback data
+    request_id = int(context.matches[0].group(1)) # Request ID matched by BID_RE
+    agent_id, agent_telegram_id = agent.id, agent.telegram_id # Still readable after a rollback expires the agent object
 
     try:
-        support_request = db.query(SupportRequest).get(request_id) # Get the request from DB
+        # Claim the request in one conditional UPDATE; it only matches while the request is still pending
+        claimed = await assign_support_request(db, request_id, agent_id)
+        await db.commit() # Save changes to DB
+    except Exception as e:
+        await db.rollback() # Rollback any changes if an error occurs
+        logger.error(f"Error claiming request {request_id} by agent {agent_telegram_id}: {e}")
+        await query.edit_message_text("An error occurred while claiming the request. Please try again or contact admin.")
+        return
 
-        if not support_request:
+    if not claimed: # Another agent got there first, the request was already closed, or it doesn't exist
+        if await db.get(SupportRequest, request_id) is None:
             await query.edit_message_text("This support request does not exist.")
             return
+        await query.edit_message_text("This request has already been claimed by another agent.")
+        logger.info(f"Agent {agent_telegram_id} tried to bid on already claimed request {request_id}.")
+        return
 
-        if support_request.status == 'assigned': # Check if already claimed (race condition handling)
-            await query.edit_message_text("This request has already been claimed by another agent.")
-            logger.info(f"Agent {agent.telegram_id} tried to bid on already claimed request {request_id}.")
-            return
-
-        # If not assigned, assign it to this agent
-        support_request.agent_id = agent.id
-        support_request.status = 'assigned'
-        support_request.assigned_at = func.now() # Set assignment timestamp
-        db.add(support_request)
-        db.commit() # Save changes to DB
+    await query.edit_message_text(f"You have successfully claimed Request #{request_id}!")
+    logger.info(f"Agent {agent_telegram_id} successfully claimed request {request_id}.")
 
-        await query.edit_message_text(f"You have successfully claimed Request #{request_id}!")
-        logger.info(f"Agent {agent.telegram_id} successfully claimed request {request_id}.")
+    # The request is assigned from here on, so a failure below is logged rather than reported as a failed claim
+    try:
+        # Get the request from DB with its history preview (its full transcript isn't loaded)
+        support_request = await db.get(SupportRequest, request_id, options=[undefer(SupportRequest.history_preview)])
 
-        customer = db.query(User).get(support_request.customer_id)
+        customer = await db.get(User, support_request.customer_id)
         if customer:
             # Notify the customer that an agent has joined
             await context.application.bot.send_message(
                 chat_id=customer.telegram_id,
                 text=f"Good news! An agent ({agent.first_name or agent.username}) has joined your chat. They will be with you shortly."
             )
-            # Send conversation history to the agent
-            initial_messages = db.query(Message).filter_by(support_request_id=support_request.id).order_by(Message.timestamp).all()
-            history_text = "\n".join([f"{msg.sender.first_name or msg.sender.username}: {msg.text}" for msg in initial_messages])
+            # Send the conversation so far to the agent, kept up to date on the request as messages arrive
+            history_text = support_request.history_preview or ""
+            if len(history_text) >= HISTORY_PREVIEW_MAX_LENGTH and "\n" in history_text.rstrip("\n"):
+                history_text = history_text.split("\n", 1)[1] # Drop the oldest line, which was cut short when trimming
+            history_text = history_text.rstrip("\n")
             if history_text:
                 await context.application.bot.send_message(
-                    chat_id=agent.telegram_id,
+                    chat_id=agent_telegram_id,
                     text=f"Conversation history for Request #{request_id}:\n{history_text}"
                 )
         else:
             logger.warning(f"Customer {support_request.customer_id} not found for request {request_id} after agent claimed.")
 
     except Exception as e:
-        db.rollback() # Rollback any changes if an error occurs
-        logger.error(f"Error claiming request {request_id} by agent {agent.telegram_id}: {e}")
-        await query.edit_message_text("Failed to claim the request. It might have been claimed by someone else or an error occurred.")
-        # Re-fetch to check if it was claimed by another agent just before this one
-        support_request_after_fail = db.query(SupportRequest).get(request_id)
-        if support_request_after_fail and support_request_after_fail.status == 'assigned' and support_request_after_fail.agent_id != agent.id:
-            await query.edit_message_text("This request was just claimed by another agent.")
-        else:
-            await query.edit_message_text("An error occurred while claiming the request. Please try again or contact admin.")
+        logger.error(f"Agent {agent_telegram_id} claimed request {request_id}, but the handover messages failed: {e}")
 
 
 # /register_agent command handler
 @db_session_decorator
-async def register_agent(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
+async def register_agent(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     user = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if user.is_agent:
@@ -349,7 +389,8 @@ async def register_agent(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     user.is_agent = True # Set user as an agent
-    db.commit()
+    await db.commit()
+    forget_cached_user(user.telegram_id) # Their next message must be handled as an agent's
     await update.message.reply_text(
         "You are now registered as a support agent! "
         "Use /agent_languages to set your language proficiencies (e.g., `/agent_languages en,es`)."
@@ -359,8 +400,7 @@ async def register_agent(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # /agent_languages command handler
 @db_session_decorator
-async def set_agent_languages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
+async def set_agent_languages(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     user = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if not user.is_agent:
@@ -370,61 +410,78 @@ async def set_agent_languages(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not context.args: # If no arguments provided with the command
         await update.message.reply_text(
             f"Usage: /agent_languages <lang1,lang2,...>\n"
-            f"Your current languages: {user.language_proficiencies or 'None'}"
+            f"Your current languages: {','.join(lang.language for lang in user.languages) or 'None'}"
         )
         return
 
-    languages = ",".join(arg.lower().strip() for arg in context.args[0].split(',')) # Process languages from arguments
-    user.language_proficiencies = languages
-    db.commit()
+    requested = []
+    for arg in context.args[0].split(','): # Process languages from arguments
+        code = arg.lower().strip()
+        if code and code not in requested:
+            requested.append(code)
+    invalid = [code for code in requested if len(code) > LANGUAGE_CODE_MAX_LENGTH]
+    if invalid: # Reject the whole update rather than saving only some of the languages
+        await update.message.reply_text(
+            f"Invalid language code(s): {', '.join(invalid)}. Use short codes such as en, es or pt-br."
+        )
+        return
+    languages = ",".join(requested)
+
+    # Keep the rows for languages the agent still has, add the new ones; the rest are deleted in the same commit
+    current = [lang for lang in user.languages if lang.language in requested]
+    current_codes = [lang.language for lang in current]
+    user.languages = current + [AgentLanguage(language=code) for code in requested if code not in current_codes]
+    await db.commit()
+    forget_cached_user(user.telegram_id)
+    schedule_agent_view_refresh() # Keep the agent lookup view in sync
     await update.message.reply_text(f"Your language proficiencies have been set to: {languages}")
     logger.info(f"Agent {user.telegram_id} updated languages to {languages}.")
 
 # /agent_status command handler
 @db_session_decorator
-async def toggle_agent_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
+async def toggle_agent_status(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     user = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if not user.is_agent:
         await update.message.reply_text("You are not registered as an agent.")
         return
 
-    user.is_available = not user.is_available # Toggle availability
-    db.commit()
-    status_text = "available" if user.is_available else "unavailable"
+    is_available = await toggle_agent_availability(db, user.id) # One UPDATE, safe when two /agent_status commands arrive at once
+    await db.commit()
+    forget_cached_user(user.telegram_id)
+    schedule_agent_view_refresh() # Keep the agent lookup view in sync
+    status_text = "available" if is_available else "unavailable"
     await update.message.reply_text(f"Your status has been set to: {status_text}")
     logger.info(f"Agent {user.telegram_id} toggled status to {status_text}.")
 
 # /close_request command handler (for agents)
 @db_session_decorator
-async def close_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
+async def close_request(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     user = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if not user.is_agent:
         await update.message.reply_text("Only agents can close requests.")
         return
 
-    # Find the request currently assigned to this agent and is active
-    active_request = db.query(SupportRequest).filter(
+    # Find the request currently assigned to this agent and is active (just the columns needed to close it)
+    active_request = (await db.execute(select(SupportRequest.id, SupportRequest.customer_id).where(
         SupportRequest.agent_id == user.id,
-        SupportRequest.status == 'assigned'
-    ).first()
+        SupportRequest.status == SRStatus.ASSIGNED
+    ).limit(1))).first()
 
     if not active_request:
         await update.message.reply_text("You are not currently assigned to an active request to close.")
         return
 
-    active_request.status = 'closed' # Set status to closed
-    active_request.closed_at = func.now() # Set closed timestamp
-    db.commit()
+    await close_support_request(db, active_request.id) # Set status to closed and the closed timestamp
+    await db.commit()
 
-    customer = db.query(User).get(active_request.customer_id)
-    if customer:
+    customer_telegram_id = await get_telegram_id_cached(db, active_request.customer_id)
+    if customer_telegram_id:
+        context.application.drop_user_data(customer_telegram_id) # Forget the customer's finished conversation state
         # Notify the customer that their request is closed
         await context.application.bot.send_message(
-            chat_id=customer.telegram_id,
+            chat_id=customer_telegram_id,
             text=f"Your support request has been closed by Agent {user.first_name or user.username}. "
                  "If you need further assistance, please start a new request with /start."
         )
@@ -434,8 +491,7 @@ async def close_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # /view_requests command handler (for agents)
 @db_session_decorator
-async def view_agent_requests(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db: Session = context.user_data['_db']
+async def view_agent_requests(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession) -> None:
     agent = await get_or_create_user(db, update.effective_user.id, update.effective_user.username, update.effective_user.first_name)
 
     if not agent.is_agent:
@@ -443,43 +499,34 @@ async def view_agent_requests(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     # Get requests currently assigned to this agent
-    assigned_requests = db.query(SupportRequest).filter(
+    assigned_requests = (await db.scalars(select(SupportRequest).options(joinedload(SupportRequest.customer).raiseload(User.languages)).where(
         SupportRequest.agent_id == agent.id,
-        SupportRequest.status == 'assigned'
-    ).all()
+        SupportRequest.status == SRStatus.ASSIGNED
+    ))).all() # Customers come from the same query (JOIN), not one query per request, without their agent languages
 
     assigned_text = "Your Assigned Requests:\n"
     if assigned_requests:
         for req in assigned_requests:
-            customer = db.query(User).get(req.customer_id)
-            assigned_text += f"- ID: {req.id}, Customer: {customer.first_name or customer.username}, Lang: {req.language}\n"
+            assigned_text += f"- ID: {req.id}, Customer: {req.customer.first_name or req.customer.username}, Lang: {req.language}\n"
     else:
         assigned_text += "None.\n"
 
     # Get pending requests that this agent is proficient in
-    # We split the agent's language proficiencies and check if the request language is in that list
-    
-    agent_langs = []
-    if agent.language_proficiencies: # This checks if it's not None and not an empty string
-        agent_langs = [lang.strip() for lang in agent.language_proficiencies.split(',')]
+    # We check if the request language is in the agent's list of languages
+    agent_langs = [lang.language for lang in agent.languages]
 
-    pending_requests = db.query(SupportRequest).filter(
-        SupportRequest.status == 'pending',
-        SupportRequest.language.in_(agent_langs)
-    ).all()
+    requests_to_bid = await pending_requests(db, agent_langs) # Oldest first
 
     await update.message.reply_text(assigned_text) # Send assigned requests first
 
     pending_text = "\nPending Requests (you can bid on):\n"
-    if pending_requests:
-        for req in pending_requests:
-            customer = db.query(User).get(req.customer_id)
-            keyboard = [[InlineKeyboardButton("Bid", callback_data=f"bid_{req.id}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    if requests_to_bid:
+        for req in requests_to_bid:
+            reply_markup = bid_markup(req.id)
             # Send each pending request as a separate message with a "Bid" button
             await update.message.reply_text(
                 f"🚨 Pending Request #{req.id} 🚨\n"
-                f"Customer: {customer.first_name or customer.username}\n"
+                f"Customer: {req.customer.first_name or req.customer.username}\n"
                 f"Language: {req.language.upper()}\n"
                 f"Status: Pending\n"
                 f"Time: {req.created_at.strftime('%Y-%m-%d %H:%M:%S')}",
@@ -496,36 +543,74 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if update.effective_message:
         await update.effective_message.reply_text("An internal error occurred. Please try again later.")
 
+# Finish pending database work and close the pooled connections when the bot shuts down
+async def close_database(application: Application) -> None:
+    await flush_agent_view_refresh() # Don't leave the agent lookup view behind the latest changes
+    await async_engine.dispose()
+
 # --- Main function to run the bot ---
 def main() -> None:
-    # 1. Initialize the database (create tables if they don't exist)
-    init_db()
+    # 1. The database schema is managed outside the bot ("python database.py" or "alembic upgrade head"),
+    #    so startup never runs DDL
 
-    # 2. Build the Telegram Application instance (our bot)
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # Without the secret, anyone who finds the webhook URL could post updates pretending to be any user
+        raise SystemExit("WEBHOOK_SECRET must be set when WEBHOOK_URL is set.")
 
-    # 3. Register Handlers: These tell the bot what to do when it receives different types of updates
+    # 2. Use uvloop for the bot's event loop when it's installed; the standard asyncio loop works too, just a bit slower
+    if uvloop is not None:
+        asyncio.set_event_loop(uvloop.new_event_loop()) # Picked up by run_polling()/run_webhook()
+
+    # 3. Build the Telegram Application instance (our bot)
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).post_shutdown(close_database)
+    try:
+        # Queues outgoing messages that would exceed Telegram's limits instead of failing them (e.g. large notification fan-outs)
+        builder.rate_limiter(AIORateLimiter())
+    except RuntimeError: # Raised when the optional "rate-limiter" extra isn't installed
+        logger.warning('Rate limiting disabled: install "python-telegram-bot[rate-limiter]" to enable it.')
+    if PERSISTENCE_FILE:
+        # Only user_data holds state in this bot; it is written to "<PERSISTENCE_FILE>_user_data"
+        builder.persistence(PicklePersistence(
+            filepath=PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            single_file=False
+        ))
+    application = builder.build()
+
+    # 4. Register Handlers: These tell the bot what to do when it receives different types of updates
+    #    block=False lets the bot start on the next update while a handler is still waiting on Telegram or the database
 
     # Customer-facing handlers
-    application.add_handler(CommandHandler("start", start)) # Handles /start command
-    application.add_handler(CallbackQueryHandler(handle_language_selection, pattern="^lang_")) # Handles button presses for language selection
+    application.add_handler(CommandHandler("start", start, block=False)) # Handles /start command
+    application.add_handler(CallbackQueryHandler(handle_language_selection, pattern=LANG_RE, block=False)) # Handles button presses for language selection
     # Handles any non-command text message. It intelligently delegates if it's an agent.
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_customer_message, block=False))
 
     # Agent-facing handlers
-    application.add_handler(CommandHandler("register_agent", register_agent)) # Handles /register_agent
-    application.add_handler(CommandHandler("agent_languages", set_agent_languages)) # Handles /agent_languages
-    application.add_handler(CommandHandler("agent_status", toggle_agent_status)) # Handles /agent_status
-    application.add_handler(CommandHandler("close_request", close_request)) # Handles /close_request
-    application.add_handler(CommandHandler("view_requests", view_agent_requests)) # Handles /view_requests
-    application.add_handler(CallbackQueryHandler(handle_bid, pattern="^bid_")) # Handles button presses for bidding
-
-    # 4. Register the global error handler
+    application.add_handler(CommandHandler("register_agent", register_agent, block=False)) # Handles /register_agent
+    application.add_handler(CommandHandler("agent_languages", set_agent_languages, block=False)) # Handles /agent_languages
+    application.add_handler(CommandHandler("agent_status", toggle_agent_status, block=False)) # Handles /agent_status
+    application.add_handler(CommandHandler("close_request", close_request, block=False)) # Handles /close_request
+    application.add_handler(CommandHandler("view_requests", view_agent_requests, block=False)) # Handles /view_requests
+    application.add_handler(CallbackQueryHandler(handle_bid, pattern=BID_RE, block=False)) # Handles button presses for bidding
+
+    # 5. Register the global error handler
     application.add_error_handler(error_handler)
 
-    # 5. Start the bot: This continuously checks for new updates from Telegram
-    logger.info("Bot started polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # 6. Start the bot: Receive updates through the webhook if one is configured, otherwise keep checking Telegram for them
+    if WEBHOOK_URL:
+        logger.info(f"Bot started listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"), # Serve updates on the same path Telegram posts them to
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET, # Checked against the header of every incoming update
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.info("Bot started polling...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
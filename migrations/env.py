@@ -0,0 +1,57 @@
+# migrations/env.py
+from logging.config import fileConfig
+
+from alembic import context
+
+# Import our configurations and database models
+from config import DATABASE_URL
+from database import Base, engine
+
+config = context.config # The Alembic config object, gives access to alembic.ini
+
+# Set up Python logging from alembic.ini
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata # Our models, used by "alembic revision --autogenerate"
+
+# Views are created by hand-written migrations, so autogenerate must not treat them as tables
+def include_object(obj, name, type_, reflected, compare_to):
+    if type_ == "table" and obj.info.get("is_view"):
+        return False
+    return True
+
+# Offline mode: print the SQL instead of running it ("alembic upgrade head --sql")
+def run_migrations_offline() -> None:
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+# Online mode: run the migrations against the database using the bot's own engine
+def run_migrations_online() -> None:
+    with engine.connect() as connection:
+        if connection.dialect.name == "sqlite":
+            # Batch migrations rebuild tables by dropping the old copy, which foreign key checks would refuse
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            render_as_batch=connection.dialect.name == "sqlite", # SQLite can't ALTER most columns in place
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+        if connection.dialect.name == "sqlite":
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON") # The connection is shared with the app afterwards
+            connection.commit()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,61 @@
+"""Initial schema: users, support_requests and messages, exactly as the original init_db() created them
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-15 09:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('telegram_id', sa.Integer(), nullable=False, unique=True),
+        sa.Column('username', sa.String(), nullable=True),
+        sa.Column('first_name', sa.String(), nullable=True),
+        sa.Column('is_agent', sa.Boolean(), nullable=True),
+        sa.Column('language_proficiencies', sa.String(), nullable=True),
+        sa.Column('is_available', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+    )
+
+    op.create_table(
+        'support_requests',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('customer_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('agent_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=True),
+        sa.Column('language', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+        sa.Column('assigned_at', sa.DateTime(), nullable=True),
+        sa.Column('closed_at', sa.DateTime(), nullable=True),
+    )
+
+    op.create_table(
+        'messages',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('support_request_id', sa.Integer(), sa.ForeignKey('support_requests.id'), nullable=False),
+        sa.Column('sender_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('messages')
+    op.drop_table('support_requests')
+    op.drop_table('users')
@@ -0,0 +1,36 @@
+"""Index hot-path columns on users, support_requests and messages
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-15 09:15:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001a'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_user_agent_avail', 'users', ['is_agent', 'is_available'])
+    op.create_index('ix_sr_status_language', 'support_requests', ['status', 'language'])
+    op.create_index('ix_sr_agent_status', 'support_requests', ['agent_id', 'status'])
+    op.create_index('ix_sr_customer', 'support_requests', ['customer_id'])
+    op.create_index('ix_msg_sr_ts', 'messages', ['support_request_id', 'timestamp'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_msg_sr_ts', table_name='messages')
+    op.drop_index('ix_sr_customer', table_name='support_requests')
+    op.drop_index('ix_sr_agent_status', table_name='support_requests')
+    op.drop_index('ix_sr_status_language', table_name='support_requests')
+    op.drop_index('ix_user_agent_avail', table_name='users')
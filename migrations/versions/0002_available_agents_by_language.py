@@ -0,0 +1,44 @@
+"""Materialized view available_agents_by_language (PostgreSQL only)
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-15 09:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return # Other databases look agents up from the users table directly
+
+    # One row per (available agent, language), exploded from the comma-separated proficiencies
+    op.execute("""
+        CREATE MATERIALIZED VIEW available_agents_by_language AS
+        SELECT DISTINCT u.id AS user_id,
+               trim(lang) AS language
+        FROM users u,
+             unnest(string_to_array(u.language_proficiencies, ',')) AS lang
+        WHERE u.is_agent AND u.is_available AND trim(lang) <> ''
+    """)
+    # The unique index is required for REFRESH MATERIALIZED VIEW CONCURRENTLY
+    op.execute("CREATE UNIQUE INDEX ux_available_agents_user_lang ON available_agents_by_language (user_id, language)")
+    op.execute("CREATE INDEX ix_available_agents_lang ON available_agents_by_language (language)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("DROP MATERIALIZED VIEW IF EXISTS available_agents_by_language")
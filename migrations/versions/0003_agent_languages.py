@@ -0,0 +1,102 @@
+"""Move agent languages from users.language_proficiencies into agent_languages
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-15 10:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    is_postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    agent_languages = op.create_table(
+        'agent_languages',
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), primary_key=True),
+        sa.Column('language', sa.String(8), primary_key=True),
+    )
+    op.create_index('ix_agent_lang', 'agent_languages', ['language', 'user_id'])
+
+    # Backfill: one row per language in each user's comma-separated list
+    if is_postgresql:
+        op.execute("""
+            INSERT INTO agent_languages (user_id, language)
+            SELECT DISTINCT u.id, lower(trim(lang))
+            FROM users u,
+                 unnest(string_to_array(u.language_proficiencies, ',')) AS lang
+            WHERE trim(lang) <> ''
+        """)
+    else:
+        users = sa.table('users', sa.column('id', sa.Integer), sa.column('language_proficiencies', sa.String))
+        rows = []
+        for user_id, proficiencies in op.get_bind().execute(sa.select(users.c.id, users.c.language_proficiencies)):
+            codes = {code.strip().lower() for code in (proficiencies or '').split(',') if code.strip()}
+            rows.extend({'user_id': user_id, 'language': code} for code in sorted(codes))
+        if rows:
+            op.bulk_insert(agent_languages, rows)
+
+    if is_postgresql:
+        # The view reads language_proficiencies, so rebuild it on top of agent_languages
+        op.execute("DROP MATERIALIZED VIEW available_agents_by_language")
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('language_proficiencies')
+
+    if is_postgresql:
+        op.execute("""
+            CREATE MATERIALIZED VIEW available_agents_by_language AS
+            SELECT al.user_id, al.language
+            FROM agent_languages al
+            JOIN users u ON u.id = al.user_id
+            WHERE u.is_agent AND u.is_available
+        """)
+        op.execute("CREATE UNIQUE INDEX ux_available_agents_user_lang ON available_agents_by_language (user_id, language)")
+        op.execute("CREATE INDEX ix_available_agents_lang ON available_agents_by_language (language)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    is_postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    if is_postgresql:
+        op.execute("DROP MATERIALIZED VIEW available_agents_by_language")
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('language_proficiencies', sa.String(), nullable=True))
+
+    # Fold the rows back into each user's comma-separated list
+    users = sa.table('users', sa.column('id', sa.Integer), sa.column('language_proficiencies', sa.String))
+    agent_languages = sa.table('agent_languages', sa.column('user_id', sa.Integer), sa.column('language', sa.String))
+    proficiencies = {}
+    for user_id, language in op.get_bind().execute(
+        sa.select(agent_languages.c.user_id, agent_languages.c.language).order_by(agent_languages.c.language)
+    ):
+        proficiencies.setdefault(user_id, []).append(language)
+    for user_id, languages in proficiencies.items():
+        op.execute(users.update().where(users.c.id == user_id).values(language_proficiencies=','.join(languages)))
+
+    op.drop_table('agent_languages')
+
+    if is_postgresql:
+        op.execute("""
+            CREATE MATERIALIZED VIEW available_agents_by_language AS
+            SELECT DISTINCT u.id AS user_id,
+                   trim(lang) AS language
+            FROM users u,
+                 unnest(string_to_array(u.language_proficiencies, ',')) AS lang
+            WHERE u.is_agent AND u.is_available AND trim(lang) <> ''
+        """)
+        op.execute("CREATE UNIQUE INDEX ux_available_agents_user_lang ON available_agents_by_language (user_id, language)")
+        op.execute("CREATE INDEX ix_available_agents_lang ON available_agents_by_language (language)")
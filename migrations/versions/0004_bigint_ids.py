@@ -0,0 +1,50 @@
+"""Widen users.telegram_id and messages.id to BIGINT
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-15 10:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column(
+            'telegram_id', existing_type=sa.Integer(), type_=sa.BigInteger(),
+            existing_nullable=False, postgresql_using='telegram_id::bigint',
+        )
+    if op.get_bind().dialect.name != 'sqlite': # SQLite INTEGER keys are already 64-bit
+        op.alter_column(
+            'messages', 'id', existing_type=sa.Integer(), type_=sa.BigInteger(),
+            postgresql_using='id::bigint',
+        )
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER SEQUENCE messages_id_seq AS bigint") # SERIAL sequences are capped at 32 bits too
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER SEQUENCE messages_id_seq AS integer")
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column(
+            'messages', 'id', existing_type=sa.BigInteger(), type_=sa.Integer(),
+            postgresql_using='id::integer',
+        )
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column(
+            'telegram_id', existing_type=sa.BigInteger(), type_=sa.Integer(),
+            existing_nullable=False, postgresql_using='telegram_id::integer',
+        )
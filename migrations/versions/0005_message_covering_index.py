@@ -0,0 +1,36 @@
+"""Replace ix_msg_sr_ts with a covering index for transcripts
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-15 11:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, Sequence[str], None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    server_version = bind.dialect.server_version_info # None when generating SQL offline
+    if bind.dialect.name == 'postgresql' and server_version is not None and server_version < (11,):
+        # INCLUDE needs PostgreSQL 11+; fall back to a plain index matching "ORDER BY timestamp DESC"
+        op.create_index('ix_msg_sr_ts_cover', 'messages', ['support_request_id', sa.text('timestamp DESC')])
+    else:
+        op.create_index('ix_msg_sr_ts_cover', 'messages', ['support_request_id', 'timestamp'], postgresql_include=['sender_id'])
+    op.drop_index('ix_msg_sr_ts', table_name='messages')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index('ix_msg_sr_ts', 'messages', ['support_request_id', 'timestamp'])
+    op.drop_index('ix_msg_sr_ts_cover', table_name='messages')
@@ -0,0 +1,32 @@
+"""Partial index on open support requests
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-15 11:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, Sequence[str], None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_sr_pending', 'support_requests', ['language', 'created_at'],
+        postgresql_where=sa.text("status IN ('pending','assigned')"),
+        sqlite_where=sa.text("status IN ('pending','assigned')"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sr_pending', table_name='support_requests')
@@ -0,0 +1,106 @@
+"""Partition messages by month on timestamp (PostgreSQL 11+)
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-15 12:00:00
+
+"""
+from datetime import date, timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, Sequence[str], None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONTHS_AHEAD = 3 # Partitions created beyond the current month; database.create_message_partitions() adds more later
+
+
+def _next_month(month: date) -> date:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        # Only the NOT NULL timestamp applies elsewhere (it is part of the partitioned primary key on PostgreSQL)
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=False, existing_server_default=sa.func.now())
+        return
+
+    # Move the existing table aside; index and constraint names must be freed for the new table
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+    op.execute("ALTER INDEX ix_msg_sr_ts_cover RENAME TO ix_msg_sr_ts_cover_unpartitioned")
+
+    # The partition key has to be part of the primary key
+    op.execute("""
+        CREATE TABLE messages (
+            id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+            support_request_id INTEGER NOT NULL REFERENCES support_requests (id),
+            sender_id INTEGER NOT NULL REFERENCES users (id),
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id") # Keep the sequence when the old table is dropped
+
+    # One partition per month from the oldest message up to a few months ahead
+    month = date.today().replace(day=1)
+    if not op.get_context().as_sql: # Existing data is only visible when running against a live database
+        oldest = op.get_bind().execute(sa.text("SELECT min(timestamp) FROM messages_unpartitioned")).scalar()
+        if oldest is not None:
+            month = min(month, oldest.date().replace(day=1))
+    last_month = date.today().replace(day=1)
+    for _ in range(MONTHS_AHEAD):
+        last_month = _next_month(last_month)
+    while month <= last_month:
+        op.execute(
+            f"CREATE TABLE messages_p{month:%Y%m} PARTITION OF messages "
+            f"FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')"
+        )
+        month = _next_month(month)
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT") # Catches rows outside the created months
+
+    op.execute("""
+        INSERT INTO messages (id, support_request_id, sender_id, text, timestamp)
+        SELECT id, support_request_id, sender_id, text, COALESCE(timestamp, now())
+        FROM messages_unpartitioned
+    """)
+    op.execute("DROP TABLE messages_unpartitioned")
+    op.create_index('ix_msg_sr_ts_cover', 'messages', ['support_request_id', 'timestamp'], postgresql_include=['sender_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('messages') as batch_op:
+            batch_op.alter_column('timestamp', existing_type=sa.DateTime(), nullable=True, existing_server_default=sa.func.now())
+        return
+
+    op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+    op.execute("ALTER INDEX ix_msg_sr_ts_cover RENAME TO ix_msg_sr_ts_cover_partitioned")
+    op.execute("""
+        CREATE TABLE messages (
+            id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+            support_request_id INTEGER NOT NULL REFERENCES support_requests (id),
+            sender_id INTEGER NOT NULL REFERENCES users (id),
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE DEFAULT now(),
+            PRIMARY KEY (id)
+        )
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("""
+        INSERT INTO messages (id, support_request_id, sender_id, text, timestamp)
+        SELECT id, support_request_id, sender_id, text, timestamp
+        FROM messages_partitioned
+    """)
+    op.execute("DROP TABLE messages_partitioned") # Also drops its partitions
+    op.create_index('ix_msg_sr_ts_cover', 'messages', ['support_request_id', 'timestamp'], postgresql_include=['sender_id'])
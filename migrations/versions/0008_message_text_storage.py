@@ -0,0 +1,46 @@
+"""Bound messages.text to 4096 characters and keep message rows inline
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-15 12:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0008'
+down_revision: Union[str, Sequence[str], None] = '0007'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TOAST_TUPLE_TARGET = 8160 # Keep in sync with database.MESSAGE_TOAST_TUPLE_TARGET
+
+
+def _partitions():
+    # Storage parameters can't be set on a partitioned table itself, only on its partitions
+    return [row[0] for row in op.get_bind().execute(sa.text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"
+    ))]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.alter_column('text', existing_type=sa.Text(), type_=sa.String(4096), existing_nullable=False)
+    if op.get_bind().dialect.name == 'postgresql' and not op.get_context().as_sql:
+        for partition in _partitions():
+            op.execute(f"ALTER TABLE {partition} SET (toast_tuple_target = {TOAST_TUPLE_TARGET})")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql' and not op.get_context().as_sql:
+        for partition in _partitions():
+            op.execute(f"ALTER TABLE {partition} RESET (toast_tuple_target)")
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.alter_column('text', existing_type=sa.String(4096), type_=sa.Text(), existing_nullable=False)
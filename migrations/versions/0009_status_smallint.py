@@ -0,0 +1,60 @@
+"""Store support_requests.status as a small integer
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-15 13:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0009'
+down_revision: Union[str, Sequence[str], None] = '0008'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Keep in sync with database.SRStatus: pending = 0, assigned = 1, closed = 2
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # The partial index compares status with text, so it has to go before the type changes
+    op.drop_index('ix_sr_pending', table_name='support_requests')
+    # Rewrite the values as digits first, so the type change is a plain cast on every backend
+    op.execute(
+        "UPDATE support_requests SET status = CASE status "
+        "WHEN 'assigned' THEN '1' WHEN 'closed' THEN '2' ELSE '0' END"
+    )
+    with op.batch_alter_table('support_requests') as batch_op:
+        batch_op.alter_column(
+            'status', existing_type=sa.String(), type_=sa.SmallInteger(), nullable=False,
+            postgresql_using='status::smallint',
+        )
+    op.create_index(
+        'ix_sr_pending', 'support_requests', ['language', 'created_at'],
+        postgresql_where=sa.text("status IN (0, 1)"),
+        sqlite_where=sa.text("status IN (0, 1)"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sr_pending', table_name='support_requests')
+    with op.batch_alter_table('support_requests') as batch_op:
+        batch_op.alter_column(
+            'status', existing_type=sa.SmallInteger(), type_=sa.String(), nullable=True,
+            postgresql_using='status::varchar',
+        )
+    op.execute(
+        "UPDATE support_requests SET status = CASE status "
+        "WHEN '1' THEN 'assigned' WHEN '2' THEN 'closed' ELSE 'pending' END"
+    )
+    op.create_index(
+        'ix_sr_pending', 'support_requests', ['language', 'created_at'],
+        postgresql_where=sa.text("status IN ('pending','assigned')"),
+        sqlite_where=sa.text("status IN ('pending','assigned')"),
+    )
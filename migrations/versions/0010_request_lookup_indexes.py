@@ -0,0 +1,42 @@
+"""Index a customer's requests by status and narrow the pending index to pending requests
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-15 13:30:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0010'
+down_revision: Union[str, Sequence[str], None] = '0009'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_sr_customer_status', 'support_requests', ['customer_id', 'status'])
+    op.drop_index('ix_sr_customer', table_name='support_requests') # Covered by the new index's leading column
+    op.drop_index('ix_sr_pending', table_name='support_requests')
+    op.create_index(
+        'ix_sr_pending', 'support_requests', ['language', 'created_at'],
+        postgresql_where=sa.text("status = 0"),
+        sqlite_where=sa.text("status = 0"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sr_pending', table_name='support_requests')
+    op.create_index(
+        'ix_sr_pending', 'support_requests', ['language', 'created_at'],
+        postgresql_where=sa.text("status IN (0, 1)"),
+        sqlite_where=sa.text("status IN (0, 1)"),
+    )
+    op.create_index('ix_sr_customer', 'support_requests', ['customer_id'])
+    op.drop_index('ix_sr_customer_status', table_name='support_requests')
@@ -0,0 +1,71 @@
+"""Keep a preview of the latest conversation on each support request
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-15 14:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0011'
+down_revision: Union[str, Sequence[str], None] = '0010'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+HISTORY_PREVIEW_MAX_LENGTH = 4000 # Keep in sync with database.HISTORY_PREVIEW_MAX_LENGTH
+
+support_requests = sa.table(
+    'support_requests',
+    sa.column('id', sa.Integer),
+    sa.column('status', sa.SmallInteger),
+    sa.column('history_preview', sa.Text),
+)
+messages = sa.table(
+    'messages',
+    sa.column('support_request_id', sa.Integer),
+    sa.column('sender_id', sa.Integer),
+    sa.column('text', sa.String),
+    sa.column('timestamp', sa.DateTime),
+)
+users = sa.table(
+    'users',
+    sa.column('id', sa.Integer),
+    sa.column('username', sa.String),
+    sa.column('first_name', sa.String),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('support_requests', sa.Column('history_preview', sa.Text(), nullable=True))
+
+    # Fill in the preview for requests that are still waiting to be claimed; older requests never need it
+    if not op.get_context().as_sql: # Existing data is only visible when running against a live database
+        bind = op.get_bind()
+        rows = bind.execute(
+            sa.select(messages.c.support_request_id, users.c.first_name, users.c.username, messages.c.text)
+            .join(users, users.c.id == messages.c.sender_id)
+            .join(support_requests, support_requests.c.id == messages.c.support_request_id)
+            .where(support_requests.c.status == 0) # SRStatus.PENDING
+            .order_by(messages.c.support_request_id, messages.c.timestamp)
+        )
+        previews = {}
+        for request_id, first_name, username, text in rows:
+            previews[request_id] = previews.get(request_id, "") + f"{first_name or username}: {text}\n"
+        for request_id, preview in previews.items():
+            bind.execute(
+                support_requests.update()
+                .where(support_requests.c.id == request_id)
+                .values(history_preview=preview[-HISTORY_PREVIEW_MAX_LENGTH:])
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('support_requests') as batch_op:
+        batch_op.drop_column('history_preview')